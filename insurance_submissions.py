@@ -1,16 +1,30 @@
 import os
 import json
 import requests
-import glob
+import hashlib
+import math
+import re
+import sqlite3
+import threading
+import zipfile
 import shutil
 import time
-import contextlib
+import queue
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from datetime import datetime
-from IPython.display import clear_output
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai import APIError, AzureOpenAI, NotFoundError
+from pypdf import PdfReader
+import pandas as pd
+
+# sqlite-vec is only needed for the optional semantic cache
+try:
+    import sqlite_vec
+except ImportError:
+    sqlite_vec = None
 
 load_dotenv(".env")
 should_cleanup: bool = True
@@ -22,253 +36,545 @@ client = AzureOpenAI(
     azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
     )
 
-# Check if the assistant already exists by name
-assistant_name = "Insurance Submission Extractor"
-assistants = client.beta.assistants.list()
-existing_assistant = next((asst for asst in assistants if asst.name == assistant_name), None)
+# Define the instructions for extracting the policy attributes from the PDF, word files of a submission;
+# the SOV attributes are extracted separately with INSTRUCTIONS_XLSX
+INSTRUCTIONS_PDF = "You are an AI assistant who is an expert in extracting data from insurance submission documents, which include PDF and word files. You are expected to extract the following information: 1. Named Insured 2. DBA Name 3. Coverage or Peril or Exposure 4. Policy InceptionDate 5. Policy ExpirationDate."
+
+# Check if the assistant already exists, first by the id cached from an earlier run, then by name
+assistant_name = "Insurance Submission PDF Extractor"
+ASSISTANT_CACHE_PATH = ".assistant_cache.json"
+try:
+    with open(ASSISTANT_CACHE_PATH, "r", encoding="utf-8") as file:
+        assistant_cache = json.load(file)
+except (FileNotFoundError, ValueError):
+    assistant_cache = {}
+
+existing_assistant = None
+if assistant_name in assistant_cache:
+    try:
+        existing_assistant = client.beta.assistants.retrieve(assistant_cache[assistant_name])
+    except NotFoundError:
+        pass
+if not existing_assistant:
+    assistants = client.beta.assistants.list()
+    existing_assistant = next((asst for asst in assistants if asst.name == assistant_name), None)
 
 if existing_assistant:
-    assistant = existing_assistant
+    pdf_assistant = existing_assistant
 else:
-    # Create a new AI assistant for processing insurance submissions
-    assistant = client.beta.assistants.create(
+    # Create a new AI assistant for processing the documents of insurance submissions
+    pdf_assistant = client.beta.assistants.create(
         name=assistant_name,
-        instructions="You are an AI assistant who is an expert in extracting data from insurance submissions which includes PDF and excel files. You are expected to extract the following information: 1. Named Insured 2. DBA Name 3. Coverage or Peril or Exposure  4. Policy InceptionDate 5. Policy ExpirationDate 6. StreetAddress, City, State, Zip, County details of the Property 7. TotalInsuredValue, OccupancyCode of the property/properties. You will find the StreetAddress, City, State, Zip, County, TotalInsuredValue and Occupancycode attributes in the tab named 'SOV APP' in the excel file. To identify the correct columns from excel files, please examine a larger section of the data (e.g., the first 20 rows) to identify where the meaningful data starts and which columns contain the information we're interested in. For TotalInsuredValue and OccupancyCode attributes, provide unique rows only.",
+        instructions=INSTRUCTIONS_PDF,
         model=os.getenv("GPT4_DEPLOYMENT_NAME"),
-        tools=[{"type": "file_search"},{"type":"code_interpreter"}]
+        tools=[{"type": "file_search"}]
     )
 
+# Cache the assistant id so the next run can skip listing all assistants
+if assistant_cache.get(assistant_name) != pdf_assistant.id:
+    assistant_cache[assistant_name] = pdf_assistant.id
+    with open(ASSISTANT_CACHE_PATH, "w", encoding="utf-8") as file:
+        json.dump(assistant_cache, file, indent=2)
+
 # Define the directory for submissions and processed data
 SUBMISSIONS_DIR = "submissions"
-DATA_DIR = "data"
 PROCESSED_DIR = "processed"
+CACHE_DIR = os.path.join(PROCESSED_DIR, "_cache")
+SEMANTIC_CACHE_PATH = os.path.join(PROCESSED_DIR, "_semcache.db")
+FILE_REGISTRY_PATH = os.path.join(PROCESSED_DIR, "_file_registry.json")
 
 # Ensure the directories exist
 os.makedirs(SUBMISSIONS_DIR, exist_ok=True)
-os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(PROCESSED_DIR, exist_ok=True)
-
-# Define the function to monitor the status of the thread run
-def monitor_thread_run(client, thread_id, run_id):
-    status = "in_progress"
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# Define the semantic cache that maps submission fingerprint embeddings to cached outputs,
+# so that near-duplicate resubmissions (typo fixes, formatting) reuse an earlier output
+class SemanticCache:
+    def __init__(self, db_path, dimensions=1536):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.enable_load_extension(True)
+        sqlite_vec.load(self.db)
+        self.db.enable_load_extension(False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS submission_outputs (id INTEGER PRIMARY KEY, output_path TEXT NOT NULL)")
+        self.db.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS submission_embeddings USING vec0(embedding float[{dimensions}])")
+        self.db.commit()
+
+    # Return the cached output path of the most similar submission, if it is similar enough
+    def query(self, vec, thresh=0.97):
+        with self.lock:
+            nearest = self.db.execute(
+                "SELECT rowid, distance FROM submission_embeddings WHERE embedding MATCH ? AND k = 1",
+                (sqlite_vec.serialize_float32(vec),),
+            ).fetchone()
+            if not nearest:
+                return None
+            rowid, distance = nearest
+            output_path, = self.db.execute("SELECT output_path FROM submission_outputs WHERE id = ?", (rowid,)).fetchone()
+        # The embeddings are L2-normalized, so the cosine similarity follows from the L2 distance
+        similarity = 1 - distance ** 2 / 2
+        if similarity < thresh or not os.path.exists(output_path):
+            return None
+        return output_path
+
+    def update(self, vec, output_path):
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO submission_outputs (output_path) VALUES (?)", (output_path,))
+            self.db.execute(
+                "INSERT INTO submission_embeddings (rowid, embedding) VALUES (?, ?)",
+                (cursor.lastrowid, sqlite_vec.serialize_float32(vec)),
+            )
+            self.db.commit()
+
+# The semantic cache is only an optimization: without sqlite-vec, or on Python builds whose
+# sqlite3 module can't load extensions, submissions are processed without it
+SEMANTIC_CACHE = None
+if sqlite_vec is None:
+    print("sqlite-vec is not installed; the semantic cache is disabled")
+else:
+    try:
+        SEMANTIC_CACHE = SemanticCache(SEMANTIC_CACHE_PATH)
+    except (AttributeError, sqlite3.Error) as e:
+        print(f"The semantic cache is disabled: {e}")
+
+# A hit reuses another submission's output as-is. Fingerprints that are mostly boilerplate
+# (ACORD form first pages, SOV header rows) can be very similar for different insureds, so a
+# too-low threshold silently returns another insured's data; keep it strict.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.99"))
+
+# Define the number of characters of each file's text that go into a submission fingerprint
+FINGERPRINT_CHARS_PER_FILE = 2000
+
+# Define the substitutions for the escaped Unicode characters and newlines in the extraction output
+UNICODE_REPLACEMENTS = {'\\u3010': '[', '\\u3011': ']', '\\u2020': '†', '\\n': '\n'}
+UNICODE_PATTERN = re.compile("|".join(re.escape(escaped) for escaped in UNICODE_REPLACEMENTS))
+
+# Define the SOV (statement of values) extraction settings. Only the top of the SOV sheet is sent to
+# a chat completion, which maps its columns to our attributes; the rows themselves are selected,
+# renamed and deduplicated locally.
+SOV_SHEET_NAME = "SOV APP"
+SOV_SAMPLE_ROWS = 25
+SOV_LOCATION_ATTRIBUTES = ["StreetAddress", "City", "State", "Zip", "County"]
+SOV_TIV_OCCUPANCY_ATTRIBUTES = ["TotalInsuredValue", "OccupancyCode"]
+SOV_DEPLOYMENT_NAME = os.getenv("SOV_DEPLOYMENT_NAME", os.getenv("GPT4_DEPLOYMENT_NAME"))
+INSTRUCTIONS_XLSX = "You are an expert in insurance statements of values (SOV). The user provides the first rows of an SOV sheet as CSV; the first CSV column is the row number and the CSV header holds the column numbers. Column names vary between submissions and the header row is often preceded by titles or notes. Return JSON with key 'header_row' (the row number of the column header row) and key 'columns' mapping each of StreetAddress, City, State, Zip, County, TotalInsuredValue and OccupancyCode to the number of the column holding it, or null if the SOV has no such column."
+
+# Define the number of submissions processed concurrently
+SUBMISSION_WORKERS = int(os.getenv("SUBMISSION_WORKERS", "4"))
+
+# Get or create one persistent vector store per worker by name. Each submission checks
+# a store out of the pool for its documents and removes its files again afterwards,
+# so the stores are reused instead of being created and deleted for every submission.
+vector_store_name = "insurance-persistent"
+existing_vector_stores = {vs.name: vs for vs in client.beta.vector_stores.list()}
+VECTOR_STORE_POOL = queue.Queue()
+for i in range(SUBMISSION_WORKERS):
+    vector_store = existing_vector_stores.get(f"{vector_store_name}-{i}")
+    if vector_store:
+        # Remove any files left behind by an interrupted run
+        for vector_store_file in client.beta.vector_stores.files.list(vector_store_id=vector_store.id):
+            client.beta.vector_stores.files.delete(file_id=vector_store_file.id, vector_store_id=vector_store.id)
+    else:
+        vector_store = client.beta.vector_stores.create(name=f"{vector_store_name}-{i}")
+    VECTOR_STORE_POOL.put(vector_store.id)
+
+# Define the rate limiter shared by all Azure OpenAI calls on the processing path, so that concurrent
+# submissions, uploads and extractions stay within the deployment's requests-per-minute budget
+# instead of running into 429 responses and their retry backoff
+class RateLimiter:
+    def __init__(self, max_rate, time_period=60, burst=1):
+        self.interval = time_period / max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take a token from the bucket, waiting until one is available
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+            self.updated = now
+            self.tokens -= 1
+            # A negative balance reserves a future token; wait until it has been refilled
+            wait = -self.tokens * self.interval if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+AZURE_RPM = int(os.getenv("AZURE_RPM", "60"))
+if AZURE_RPM < 1:
+    raise ValueError(f"AZURE_RPM must be a positive number of requests per minute, got {AZURE_RPM}")
+RATE_LIMITER = RateLimiter(max_rate=AZURE_RPM, time_period=60, burst=max(1, AZURE_RPM // 60))
+
+# Define the number of files uploaded concurrently for a submission
+UPLOAD_WORKERS = 8
+
+# Define the delay (in seconds) between status checks of a vector store file batch
+FILE_BATCH_POLL_INTERVAL = 1.0
+
+# Load the registry of uploaded file ids keyed by file content hash, so that documents shared
+# between submissions (standard forms, cover letters) are only uploaded once
+try:
+    with open(FILE_REGISTRY_PATH, "r", encoding="utf-8") as file:
+        FILE_REGISTRY = json.load(file)
+except (FileNotFoundError, ValueError):
+    FILE_REGISTRY = {}
+FILE_REGISTRY_LOCK = threading.Lock()
+
+# Define the function to run the assistant on a thread, streaming the run's events until it finishes
+def stream_thread_run(client, thread_id, assistant_id, **run_options):
     start_time = time.time()
-    while status not in ["completed", "cancelled", "expired", "failed"]:
-        time.sleep(5)
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id,run_id=run_id)
-        print("Elapsed time: {} minutes {} seconds".format(int((time.time() - start_time) // 60), int((time.time() - start_time) % 60)))
-        status = run.status
-        print(f'Status: {status}')
-        clear_output(wait=True)
-    return run
+    RATE_LIMITER.acquire()
+    with client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=assistant_id, **run_options) as stream:
+        stream.until_done()
+        run = stream.get_final_run()
+        messages = stream.get_final_messages()
+    print("Elapsed time: {} minutes {} seconds".format(int((time.time() - start_time) // 60), int((time.time() - start_time) % 60)))
+    print(f'Status: {run.status}')
+    # Only a completed run has a complete reply; a failed, incomplete, expired or cancelled run
+    # may have streamed a partial message that must not be taken (and cached) as the result
+    if run.status != "completed":
+        raise RuntimeError(f"Run {run.id} finished with status {run.status}")
+    if not messages:
+        raise RuntimeError(f"Run {run.id} completed without a reply")
+    return run, messages
     
+# Define the function to upload a single file for use by the assistants, reusing an earlier upload of the same content
+def _upload_file(path):
+    with open(path, "rb") as file:
+        file_hash = hashlib.sha256(file.read()).hexdigest()
+        with FILE_REGISTRY_LOCK:
+            file_id = FILE_REGISTRY.get(file_hash)
+        if file_id:
+            try:
+                RATE_LIMITER.acquire()
+                client.files.retrieve(file_id)
+                return file_id
+            except NotFoundError:
+                # The earlier upload was deleted; upload the file again
+                pass
+        file.seek(0)
+        RATE_LIMITER.acquire()
+        file_id = client.files.create(file=file, purpose="assistants").id
+
+    with FILE_REGISTRY_LOCK:
+        FILE_REGISTRY[file_hash] = file_id
+        with open(FILE_REGISTRY_PATH, "w", encoding="utf-8") as registry_file:
+            json.dump(FILE_REGISTRY, registry_file, indent=2)
+    return file_id
+
+# Define the function to list the files of a directory by extension in a single scan
+def _scan(directory):
+    files = {extension: [] for extension in (".pdf", ".docx", ".xlsx", ".xls", ".csv")}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            extension = os.path.splitext(entry.name)[1].lower()
+            if extension in files and entry.is_file():
+                files[extension].append(entry.path)
+    return files
+
 # Define the function to process the submission for PDF, word files
-def process_submission_pdf(submission_folder,assistant_id):
-    # Create a new vector store for the submission documents
-    vector_store = client.beta.vector_stores.create(name="Submission Documents Vector Store")
-    
-    # Ready the files for upload to OpenAI
-    file_paths = glob.glob(os.path.join(DATA_DIR, "*.pdf")) + glob.glob(os.path.join(DATA_DIR, "*.docx"))
-    with contextlib.ExitStack() as stack:
-        file_streams = [stack.enter_context(open(path, "rb")) for path in file_paths]
- 
-        # Use the upload and poll SDK helper to upload the files, add them to the vector store,
-        # and poll the status of the file batch for completion.
-        file_batch = client.beta.vector_stores.file_batches.upload_and_poll(
-        vector_store_id=vector_store.id, files=file_streams
+def process_submission_pdf(submission_folder,assistant_id,file_paths):
+    # Check out a persistent vector store for the submission documents
+    vector_store_id = VECTOR_STORE_POOL.get()
+    file_ids = []
+    try:
+        # Upload the files in parallel, then add them to the vector store as one batch
+        # and poll the status of the file batch for completion. Identical files share a file id.
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            file_ids = list(dict.fromkeys(executor.map(_upload_file, file_paths)))
+        RATE_LIMITER.acquire()
+        file_batch = client.beta.vector_stores.file_batches.create(
+        vector_store_id=vector_store_id, file_ids=file_ids
         )
+        # Poll the batch ourselves so that every status request goes through the rate limiter
+        while file_batch.status == "in_progress":
+            time.sleep(FILE_BATCH_POLL_INTERVAL)
+            RATE_LIMITER.acquire()
+            file_batch = client.beta.vector_stores.file_batches.retrieve(
+            batch_id=file_batch.id, vector_store_id=vector_store_id
+            )
           
-    # Print the status and file counts of the batch
-    print(file_batch.status)
-    print(file_batch.file_counts)
-    
-    # Update the assistant to use the new vector store
-    assistant = client.beta.assistants.update(
-        assistant_id=assistant_id,
-        tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}},
-    )
-    # Create a thread using the vector store file and publish the output
-    thread = client.beta.threads.create()
-    message = client.beta.threads.messages.create(
-    thread_id=thread.id,
-    role="user",
-    content="Extract the following attributes from the submission: NamedInsured, DBA Name, RenewalofAccountID, Coverage or Peril or Exposure, InceptionDate, ExpirationDate"
-    )
+        # Print the status and file counts of the batch
+        print(file_batch.status)
+        print(file_batch.file_counts)
+
+        # Don't extract (and cache) attributes from an incomplete set of documents
+        if file_batch.status != "completed" or file_batch.file_counts.failed:
+            raise RuntimeError(f"File batch {file_batch.id} for {submission_folder} finished with status {file_batch.status} and {file_batch.file_counts.failed} failed files")
     
-    run = client.beta.threads.runs.create(
-    thread_id=thread.id,
-    assistant_id=assistant.id,
-    )
-       
-    # Monitor the status of the thread run
-    run = monitor_thread_run(client, thread.id, run.id)
+        # Create a thread using the vector store file and publish the output.
+        # The vector store is attached to the thread rather than the shared assistant
+        # so that concurrently processed submissions don't overwrite each other's files.
+        RATE_LIMITER.acquire()
+        thread = client.beta.threads.create(
+            tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}},
+        )
+        RATE_LIMITER.acquire()
+        message = client.beta.threads.messages.create(
+        thread_id=thread.id,
+        role="user",
+        content="Extract the following attributes from the submission and return them as JSON keyed by attribute name: NamedInsured, DBA Name, RenewalofAccountID, Coverage or Peril or Exposure, InceptionDate, ExpirationDate"
+        )
     
-    # Once the thread run is completed, retrieve the messages
-    messages = client.beta.threads.messages.list(
-    thread_id=thread.id
+        # Run the assistant on the thread in JSON mode and stream the messages it creates
+        run, messages = stream_thread_run(client, thread.id, assistant_id, response_format={"type": "json_object"})
+        if os.getenv("DEBUG"):
+            for message in messages:
+                print(message.model_dump_json(indent=2))
+
+        # Extract the data from the last message of the run
+        output_data = messages[-1].content[0].text.value
+
+        print(f"Data extracted from the documents of {submission_folder}")
+
+        # Return the extracted attributes with JSON formatting; fall back to the raw reply
+        # if the assistant didn't answer with valid JSON
+        attributes = _parse_json_reply(output_data)
+        return json.dumps(output_data if attributes is None else attributes, indent=2)
+    finally:
+        # Remove the submission's files from the vector store and return it to the pool. The
+        # cleanup is best-effort: files that were never attached (e.g. when the batch failed)
+        # can't be deleted, and the store must go back to the pool regardless.
+        try:
+            for file_id in file_ids:
+                try:
+                    RATE_LIMITER.acquire()
+                    client.beta.vector_stores.files.delete(file_id=file_id, vector_store_id=vector_store_id)
+                except APIError as e:
+                    print(f"Could not remove file {file_id} from vector store {vector_store_id}: {e}")
+        finally:
+            VECTOR_STORE_POOL.put(vector_store_id)
+
+# Define the function to read the SOV sheet of an SOV file without interpreting any header row
+def _read_sov_sheet(xlsx_path):
+    if os.path.splitext(xlsx_path)[1].lower() == ".csv":
+        return pd.read_csv(xlsx_path, header=None, dtype=str)
+    # Open the workbook once and parse only the SOV sheet from it
+    with pd.ExcelFile(xlsx_path) as book:
+        sheet_name = SOV_SHEET_NAME if SOV_SHEET_NAME in book.sheet_names else book.sheet_names[0]
+        return book.parse(sheet_name, header=None, dtype=str)
+
+# Define the function to select, rename and deduplicate the rows of the given SOV attributes
+def _sov_records(table, columns, attributes):
+    records = pd.DataFrame(
+        {attribute: table.iloc[:, columns[attribute]] if columns.get(attribute) is not None else None for attribute in attributes},
+        index=table.index,
     )
-    print(messages.model_dump_json(indent=2))    
-
-    # Extract the data from the messages
-    data = json.loads(messages.model_dump_json(indent=2))  # Load JSON data into a Python object
-    output_data = data['data'][0]['content'][0]['text']['value']  # Adjusted to access the correct content
-
-    # Write the 'value' field to a file with extra spaces and JSON formatting
-    submission_output_path = os.path.join(DATA_DIR, "submission.txt")
-    with open(submission_output_path, "w",encoding="utf-8") as file:
-        file.write(json.dumps(output_data, indent=2))  # Convert list to JSON string
-
-    print(f"Data from {submission_folder} written to submission.txt")
-    
-    # Delete the vector store after processing the submission
-    client.beta.vector_stores.delete(vector_store.id)
+    records = records.dropna(how="all").drop_duplicates()
+    return records.astype(object).where(records.notna(), None).to_dict(orient="records")
 
 # Define the function to process a submission
-def process_submission_xlsx(submission_folder,assistant_id):
+def process_submission_xlsx(submission_folder,xlsx_files):
     
-    # Ready the files for upload to OpenAI
-    xlsx_files = glob.glob(os.path.join(DATA_DIR, "*.xlsx"))+ glob.glob(os.path.join(DATA_DIR, "*.xls"))+ glob.glob(os.path.join(DATA_DIR, "*.csv"))
-
     if not xlsx_files:
-        print("No xlsx, xls, or csv files found in the data directory.")
-        return
+        print(f"No xlsx, xls, or csv files found in {submission_folder}.")
+        return ""
 
     xlsx_file_path = xlsx_files[0]
-
-    with contextlib.ExitStack() as stack:
-        xlsx_file = stack.enter_context(open(xlsx_file_path, "rb"))
-        message_file = client.files.create(
-            file=xlsx_file, purpose="assistants"
-        )
-
-    # Create a thread and attach the file to the message
-    thread = client.beta.threads.create(
-    messages=[
-    {
-    "role": "user",
-    "content": "Extract the following property attributes from the SOV and provide the unique rows of the attributes : StreetAddress, City, State, Zip, County",
-    # Attach the new file to the message.
-    "attachments": [
-    { "file_id": message_file.id, "tools": [{"type": "code_interpreter"}] }
+    sheet = _read_sov_sheet(xlsx_file_path)
+
+    # Ask a chat completion to find the header row and map the column-name variants to our
+    # attributes, showing it only the top of the sheet
+    sample_csv = sheet.head(SOV_SAMPLE_ROWS).to_csv()
+    RATE_LIMITER.acquire()
+    response = client.chat.completions.create(
+        model=SOV_DEPLOYMENT_NAME,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": INSTRUCTIONS_XLSX},
+            {"role": "user", "content": sample_csv},
         ],
-    }
-    ]
-    )
-    
-    run = client.beta.threads.runs.create(
-        thread_id=thread.id,
-        assistant_id=assistant.id,
-    )
-    
-    # Monitor the status of the thread run
-    run = monitor_thread_run(client, thread.id, run.id)
-    
-    # Once the thread run is completed, retrieve the messages
-    messages = client.beta.threads.messages.list(
-    thread_id=thread.id
     )
-    print(messages.model_dump_json(indent=2))    
 
-    # Extract the data from the messages
-    data = json.loads(messages.model_dump_json(indent=2))  # Load JSON data into a Python object
-    output_data = data['data'][0]['content'][0]['text']['value']  # Adjusted to access the correct content
+    # Extract the mapping from the completion; a reply cut off at the token limit or withheld by the
+    # content filter must not be used (and cached) as the SOV output
+    choice = response.choices[0]
+    if choice.finish_reason != "stop" or not choice.message.content:
+        raise RuntimeError(f"SOV extraction for {submission_folder} finished with reason {choice.finish_reason} without a complete reply")
+    mapping = _parse_json_reply(choice.message.content)
+
+    # Validate the mapping against the sheet before using it
+    if not isinstance(mapping, dict) or not isinstance(mapping.get("columns"), dict):
+        raise ValueError(f"Unexpected SOV column mapping for {submission_folder}: {choice.message.content}")
+    header_row, columns = mapping.get("header_row"), mapping["columns"]
+    if type(header_row) is not int or not 0 <= header_row < min(SOV_SAMPLE_ROWS, len(sheet)):
+        raise ValueError(f"Invalid SOV header row for {submission_folder}: {header_row}")
+    for attribute in SOV_LOCATION_ATTRIBUTES + SOV_TIV_OCCUPANCY_ATTRIBUTES:
+        position = columns.get(attribute)
+        if position is not None and (type(position) is not int or not 0 <= position < sheet.shape[1]):
+            raise ValueError(f"Invalid SOV column for {attribute} in {submission_folder}: {position}")
+
+    # Select, rename and deduplicate the rows below the header locally
+    table = sheet.iloc[header_row + 1:]
+    location_data = _sov_records(table, columns, SOV_LOCATION_ATTRIBUTES)
+    tiv_occupancy_data = _sov_records(table, columns, SOV_TIV_OCCUPANCY_ATTRIBUTES)
     
-    # Write the 'value' field to a file with extra spaces and JSON formatting
-    submission_output_path = os.path.join(DATA_DIR, "submission.txt")
-    with open(submission_output_path, "a", encoding="utf-8") as file:
-        file.write("\n\n------------------------\n\n" + json.dumps(output_data, indent=2) + "\n\n---------------------------------")  # Convert list to JSON string
-
-    print(f"Data from {submission_folder} written to submission.txt")
-
-    # Create a new message to extract the TotalInsuredValue and OccupancyCode
-    message = client.beta.threads.messages.create(
-    thread_id=thread.id,
-    role="user",
-    content="Extract the following attributes from the submission: TotalInsuredValue, OccupancyCode"
-    )
-
-    run = client.beta.threads.runs.create(
-    thread_id=thread.id,
-    assistant_id=assistant.id,
-    )
-    
-    # Monitor the status of the thread run
-    run = monitor_thread_run(client, thread.id, run.id)
-
-    # Once the thread run is completed, retrieve the messages
-    messages = client.beta.threads.messages.list(
-    thread_id=thread.id
-    )
-    print(messages.model_dump_json(indent=2))    
+    print(f"Data extracted from the SOV of {submission_folder}")
+
+    # Return both sections with extra spaces and JSON formatting
+    output = "\n\n------------------------\n\n" + json.dumps(location_data, indent=2) + "\n\n---------------------------------"
+    output += "\n\n" + json.dumps(tiv_occupancy_data, indent=2) + "\n\n"
+    return output
+
+
+# Define the function to parse a JSON reply from the assistant, which may be wrapped in a markdown code fence
+def _parse_json_reply(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+# Define the function to list the files of a _scan result in a stable order
+def _scanned_paths(files):
+    return sorted(path for paths in files.values() for path in paths)
+
+# Define the function to hash the contents of the scanned submission files, used as the output cache key
+def _submission_hash(files):
+    submission_hash = hashlib.sha256()
+    for path in _scanned_paths(files):
+        with open(path, "rb") as file:
+            file_hash = hashlib.sha256(file.read()).hexdigest()
+        submission_hash.update(f"{os.path.basename(path)}\0{file_hash}\n".encode("utf-8"))
+    return submission_hash.hexdigest()
+
+
+# Define the function to read the leading text of a submission file for its fingerprint
+def _read_leading_text(file_path, max_chars):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".pdf":
+        text = ""
+        for page in PdfReader(file_path).pages:
+            text += (page.extract_text() or "") + "\n"
+            if len(text) >= max_chars:
+                break
+        return text[:max_chars]
+
+    if extension == ".csv":
+        with open(file_path, "r", encoding="utf-8", errors="ignore") as file:
+            return file.read(max_chars)
+    if extension == ".xls":
+        # Legacy binary workbooks have no readily extractable text; the file name still counts
+        return ""
+
+    # DOCX and XLSX files are zip archives of XML parts; strip the markup to get at the text
+    xml_part = "word/document.xml" if extension == ".docx" else "xl/sharedStrings.xml"
+    with zipfile.ZipFile(file_path) as archive:
+        if xml_part not in archive.namelist():
+            return ""
+        with archive.open(xml_part) as part:
+            xml = part.read(max_chars * 8).decode("utf-8", errors="ignore")
+    return re.sub(r"\s+", " ", re.sub(r"<[^>]*>", " ", xml)).strip()[:max_chars]
+
+# Define the function to embed a fingerprint of the scanned submission files (file names plus leading text)
+def _submission_fingerprint(files):
+    fingerprint = []
+    for path in _scanned_paths(files):
+        fingerprint.append(os.path.basename(path))
+        fingerprint.append(_read_leading_text(path, FINGERPRINT_CHARS_PER_FILE))
+    RATE_LIMITER.acquire()
+    response = client.embeddings.create(model=os.getenv("EMBEDDING_DEPLOYMENT_NAME"), input="\n".join(fingerprint))
+    embedding = response.data[0].embedding
+
+    # L2-normalize the embedding so that similarity can be derived from L2 distance
+    norm = math.sqrt(sum(value * value for value in embedding)) or 1.0
+    return [value / norm for value in embedding]
+
+
+def _process_one(submission_folder, assistant_id):
+    submission_path = os.path.join(SUBMISSIONS_DIR, submission_folder)
+
+    # Key the caches on exactly the files that are processed
+    files = _scan(submission_path)
+    cache_path = os.path.join(CACHE_DIR, f"{_submission_hash(files)}.txt")
+
+    fingerprint = None
+    if os.path.exists(cache_path):
+        # Reuse the output of an earlier submission with identical files
+        cached_output_path = cache_path
+    elif SEMANTIC_CACHE is None:
+        cached_output_path = None
+    else:
+        # Fall back to the output of an earlier near-duplicate submission. The semantic cache is
+        # only an optimization, so a file it can't read or a failed embedding call skips it.
+        try:
+            fingerprint = _submission_fingerprint(files)
+            cached_output_path = SEMANTIC_CACHE.query(fingerprint, SEMANTIC_CACHE_THRESHOLD)
+        except Exception as e:
+            print(f"Skipping the semantic cache for {submission_folder}: {e}")
+            fingerprint, cached_output_path = None, None
+    if cached_output_path:
+        print(f"Reusing cached output for {submission_folder} (cached=True)")
+    else:
+        # Process the documents and the SOV of the submission concurrently, straight from the
+        # submission folder, keeping the extracted output in memory; they share no state
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            pdf_future = executor.submit(process_submission_pdf, submission_folder, assistant_id, files[".pdf"] + files[".docx"])
+            xlsx_future = executor.submit(process_submission_xlsx, submission_folder, files[".xlsx"] + files[".xls"] + files[".csv"])
+            text = pdf_future.result() + xlsx_future.result()
+
+        # Replace Unicode characters and newlines in a single pass
+        text = UNICODE_PATTERN.sub(lambda match: UNICODE_REPLACEMENTS[match.group(0)], text)
+
+        # Cache the cleaned output for resubmissions of the same files
+        Path(cache_path).write_text(text, encoding="utf-8")
+        if fingerprint is not None:
+            try:
+                SEMANTIC_CACHE.update(fingerprint, cache_path)
+            except Exception as e:
+                print(f"Could not add {submission_folder} to the semantic cache: {e}")
+
+    # Move the processed submission folder to the PROCESSED_DIR
+    processed_submission_path = os.path.join(PROCESSED_DIR, submission_folder)
+    shutil.move(submission_path, processed_submission_path)
+
+    # Generate a unique name for the submission output file
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    unique_submission_file = f"submission_{timestamp}.txt"
+
+    # Write the output straight to the processed directory with a unique name
+    unique_submission_path = os.path.join(processed_submission_path, unique_submission_file)
+    if cached_output_path:
+        shutil.copy(cached_output_path, unique_submission_path)
+    else:
+        Path(unique_submission_path).write_text(text, encoding="utf-8")
+    return unique_submission_path
 
-    # Extract the data from the messages
-    data = json.loads(messages.model_dump_json(indent=2))  # Load JSON data into a Python object
-    output_data = data['data'][0]['content'][0]['text']['value']  # Adjusted to access the correct content
-    
-    # Write the 'value' field to a file with extra spaces and JSON formatting
-    submission_output_path = os.path.join(DATA_DIR, "submission.txt")
-    with open(submission_output_path, "a", encoding="utf-8") as file:
-        file.write("\n\n" + json.dumps(output_data, indent=2) + "\n\n")  # Convert list to JSON string
 
-    print(f"Data from {submission_folder} written to submission.txt")
+def main():
+    assistant_id = pdf_assistant.id
 
+    # Collect all submission folders in the SUBMISSIONS_DIR
+    submission_folders = [
+        submission_folder for submission_folder in os.listdir(SUBMISSIONS_DIR)
+        if os.path.isdir(os.path.join(SUBMISSIONS_DIR, submission_folder))
+    ]
 
-def main():
-    assistant_id = assistant.id
-
-    # Loop through all submission folders in the SUBMISSIONS_DIR
-    for submission_folder in os.listdir(SUBMISSIONS_DIR):
-        submission_path = os.path.join(SUBMISSIONS_DIR, submission_folder)
-        
-        # Check if the path is a directory
-        if os.path.isdir(submission_path):
-            # Clear the DATA_DIR before copying new files
-            for file_name in os.listdir(DATA_DIR):
-                file_path = os.path.join(DATA_DIR, file_name)
-                os.remove(file_path)
-            
-            # Copy the submission files to the DATA_DIR
-            for file_name in os.listdir(submission_path):
-                file_path = os.path.join(submission_path, file_name)
-                if file_name.endswith((".pdf", ".docx", ".xlsx")):
-                    shutil.copy(file_path, DATA_DIR)
-
-            
-            # Process the submission
-            process_submission_pdf(submission_folder, assistant_id)
-            process_submission_xlsx(submission_folder, assistant_id)
-
-            # Read the content of submission.txt
-            submission_output_path = os.path.join(DATA_DIR, "submission.txt")
-            with open(submission_output_path, "r", encoding="utf-8") as file:
-                text = file.read()
-
-            # Replace Unicode characters and newlines
-            text = text.replace('\\u3010', '[')
-            text = text.replace('\\u3011', ']')
-            text = text.replace('\\u2020', '†')
-            text = text.replace('\\n', '\n')
-
-            # Write the cleaned content back to submission.txt
-            with open(submission_output_path, "w", encoding="utf-8") as file:
-                file.write(text)
-
-            # Move the processed submission folder to the PROCESSED_DIR
-            processed_submission_path = os.path.join(PROCESSED_DIR, submission_folder)
-            shutil.move(submission_path, processed_submission_path)
-            
-            # Generate a unique name for the submission.txt file
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            unique_submission_file = f"submission_{timestamp}.txt"
-            
-            # Move the submission.txt file to the processed directory with a unique name
-            shutil.move(os.path.join(DATA_DIR, "submission.txt"), os.path.join(processed_submission_path, unique_submission_file))
-           
-        # Prompt the user to continue to the next submission
-            input("Press Enter to process the next submission...")
+    # Process the submissions concurrently; the work is dominated by Azure OpenAI calls
+    with ThreadPoolExecutor(max_workers=SUBMISSION_WORKERS) as executor:
+        futures = {
+            executor.submit(_process_one, submission_folder, assistant_id): submission_folder
+            for submission_folder in submission_folders
+        }
+        for future in as_completed(futures):
+            submission_folder = futures[future]
+            # Report a failed submission and leave it in SUBMISSIONS_DIR without aborting the batch
+            try:
+                output_path = future.result()
+            except Exception as e:
+                print(f"Failed to process {submission_folder}: {e}")
+                continue
+            print(f"Processed {submission_folder} -> {output_path}")
     print("All submissions have been processed.")
     
     # # Delete the assistant after processing all submissions
-    # client.beta.assistants.delete(assistant.id)
+    # client.beta.assistants.delete(pdf_assistant.id)
 
 if __name__ == "__main__":
     main()